@@ -52,9 +52,9 @@ def train_seg(model, folder, manager, start, save_dir):
                 print('Current patient: ', patient)
 
                 # Load their scans
-                ct = np.load(folder + '/' + patient + '/CT.npy').astype(float)
-                pet = np.load(folder + '/' + patient + '/PET.npy').astype(float)
-                mask = np.load(folder + '/' + patient + '/mask.npy').astype(float)
+                ct = np.load(folder + '/' + patient + '/CT.npy').astype(np.float32)
+                pet = np.load(folder + '/' + patient + '/PET.npy').astype(np.float32)
+                mask = np.load(folder + '/' + patient + '/mask.npy').astype(np.float32)
                 print(ct.shape, pet.shape,  mask.shape)
 
                 # Cut the random cubes
@@ -180,9 +180,9 @@ def train_class(model, folder, demo_data, manager, start, save_dir):
                 print('Current patient: ', patient)
 
                 # Load their scans
-                ct = np.load(folder + '/' + patient + '/CT.npy').astype(float)
-                pet = np.load(folder + '/' + patient + '/PET.npy').astype(float)
-                mask = np.load(folder + '/' + patient + '/mask.npy').astype(float)
+                ct = np.load(folder + '/' + patient + '/CT.npy').astype(np.float32)
+                pet = np.load(folder + '/' + patient + '/PET.npy').astype(np.float32)
+                mask = np.load(folder + '/' + patient + '/mask.npy').astype(np.float32)
 
                 # Cut the random cubes
                 try:
@@ -306,9 +306,9 @@ def tests(model):
 def test_model(model, folder):
 
     # Load their scans
-    ct = np.load(folder + '/CT.npy').astype(float)
-    pet = np.load(folder + '/PET.npy').astype(float)
-    mask = np.load(folder + '/mask_original.npy').astype(float)
+    ct = np.load(folder + '/CT.npy').astype(np.float32)
+    pet = np.load(folder + '/PET.npy').astype(np.float32)
+    mask = np.load(folder + '/mask_original.npy').astype(np.float32)
 
     # Cut the random cubes
     ct_final, pet_final, mask_final, half_mask, quarter_mask, _ = cut_random_cubes(ct, pet, mask)
@@ -9,6 +9,38 @@ import nrrd
 import time
 # import raster_geometry as mrt
 import pandas as pd
+import traceback
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import repeat
+
+# Use the GPU for the big resampling zooms if cupy is around and can see a GPU, scipy otherwise
+try:
+    import cupy as cp
+    from cupyx.scipy.ndimage import zoom as _zoom_gpu
+except ImportError:
+    cp = None
+
+# Whether cupy can actually see a GPU, only checked on the first zoom so importing this doesn't start up CUDA
+_gpu_available = None
+
+# Threads for reading and decoding DICOM files, kept small since process_data runs several patients at once
+_IO_THREADS = 4
+
+# What the files in a patient folder look like
+_DCM_SUFFIX = '.dcm'
+_PET_RE = re.compile(r'PET*')
+_GTV_RE = re.compile(r'.*GTV\.nrrd')
+
+def _sort_by_z(slices):
+    """
+    Sorts the slices by their z position, only looking up each position once
+    :param slices: list of databases
+    :return: sorted list of databases, sorted z positions
+    """
+    z = np.fromiter((float(s.ImagePositionPatient[2]) for s in slices), dtype=np.float64, count=len(slices))
+    order = np.argsort(z, kind='stable')
+    return [slices[i] for i in order], z[order]
 
 
 def load_scan(path):
@@ -18,39 +50,41 @@ def load_scan(path):
     :return: ct, pet, tumor databases
     """
 
-    # .dcm files are the ct scan
-    ct_slices = [pydicom.read_file(path + '/' + s) for s in os.listdir(path) if re.match(r'.*\.dcm', s)]
+    # Only list the folder once
+    entries = os.listdir(path)
 
-    # Files with IM_XXX and no extension are the PET scan
-    pet_slices = [pydicom.read_file(path + '/' + s) for s in os.listdir(path) if re.match(r'PET*', s)]
+    # .dcm files are the ct scan, files with IM_XXX and no extension are the PET scan
+    # Pixel data is deferred so only the headers are read until pixel_array is needed
+    # Read them on a few threads since it's mostly waiting on the disk
+    with ThreadPoolExecutor(max_workers=_IO_THREADS) as executor:
+        ct_slices = list(executor.map(lambda s: pydicom.dcmread(path + '/' + s, defer_size='1 KB'),
+                                      [s for s in entries if s.endswith(_DCM_SUFFIX)]))
+        pet_slices = list(executor.map(lambda s: pydicom.dcmread(path + '/' + s, defer_size='1 KB'),
+                                       [s for s in entries if _PET_RE.match(s)]))
 
     # Sort them so it's in order
-    ct_slices.sort(key=lambda x: float(x.ImagePositionPatient[2]))
-    pet_slices.sort(key=lambda x: float(x.ImagePositionPatient[2]))
+    ct_slices, ct_z = _sort_by_z(ct_slices)
+    pet_slices, pet_z = _sort_by_z(pet_slices)
 
     # Find the tumor mask
-    for s in os.listdir(path):
-        if re.match(r'.*GTV\.nrrd', s):
+    for s in entries:
+        if _GTV_RE.match(s):
             segmentation = nrrd.read(path + '/' + s)
 
     # A bunch of ways to find the z-axis spacing RIP
-    try:
-        try:
-            ct_slice_thickness = np.abs(ct_slices[0].ImagePositionPatient[2] - ct_slices[1].ImagePositionPatient[2])
-            pet_slice_thickness = np.abs(pet_slices[0].ImagePositionPatient[2] - pet_slices[1].ImagePositionPatient[2])
-        except:
-            ct_slice_thickness = np.abs(pet_slices[0].SliceLocation - pet_slices[1].SliceLocation)
-            pet_slice_thickness = np.abs(pet_slices[0].SliceLocation - pet_slices[1].SliceLocation)
-    except:
+    # Check what's there up front instead of waiting for exceptions, the z positions come from sorting
+    if len(ct_z) > 1 and len(pet_z) > 1:
+        ct_slice_thickness = np.abs(ct_z[0] - ct_z[1])
+        pet_slice_thickness = np.abs(pet_z[0] - pet_z[1])
+    elif len(pet_slices) > 1 and all(hasattr(s, 'SliceLocation') for s in pet_slices[:2]):
+        ct_slice_thickness = pet_slice_thickness = np.abs(pet_slices[0].SliceLocation - pet_slices[1].SliceLocation)
+    else:
         ct_slice_thickness = ct_slices[0][0x18, 0x50].value
         pet_slice_thickness = pet_slices[0][0x18, 0x50].value
 
-    # Make sure they remember their z-axis spacing
-    for s in ct_slices:
-        s.SliceThickness = ct_slice_thickness
-
-    for s in pet_slices:
-        s.SliceThickness = pet_slice_thickness
+    # Make sure they remember their z-axis spacing, resample only ever looks at the first slice
+    ct_slices[0].SliceThickness = ct_slice_thickness
+    pet_slices[0].SliceThickness = pet_slice_thickness
 
     return ct_slices, pet_slices, segmentation
 
@@ -61,10 +95,19 @@ def get_pixels_hu(slices, pet):
     :param slices: list of databases representing a DICOM scan
     :return: NumPy array of pixel values
     """
-    image = np.stack([s.pixel_array for s in slices])
     # Convert to int16 (from sometimes int16),
     # should be possible as values should always be low enough (<32k)
-    image = image.astype(np.int16)
+    # Decode the first slice to find the size, then the rest go straight into their spot in the volume
+    first = slices[0].pixel_array
+    image = np.empty((len(slices),) + first.shape, dtype=np.int16)
+    image[0] = first
+
+    def decode(i):
+        image[i] = slices[i].pixel_array
+
+    # Decode the slices in parallel, pydicom and numpy let go of the GIL for most of it
+    with ThreadPoolExecutor(max_workers=_IO_THREADS) as executor:
+        list(executor.map(decode, range(1, len(slices))))
 
     # --- NOT SURE IF I NEED THIS ---
     # # Set outside-of-scan pixels to 0
@@ -73,20 +116,56 @@ def get_pixels_hu(slices, pet):
 
     if not pet:
         # Convert to the numbers they should be, DICOM is stupid
-        for slice_number in range(len(slices)):
+        # Get every slope and intercept at once so the whole volume is rescaled in one pass
+        slopes = np.fromiter((s.RescaleSlope for s in slices), dtype=np.float32, count=len(slices))
+        intercepts = np.fromiter((s.RescaleIntercept for s in slices), dtype=np.float32, count=len(slices))
+
+        # Change the slope and add the intercept
+        image = np.rint(image.astype(np.float32) * slopes[:, None, None] + intercepts[:, None, None]).astype(np.int16)
+
+    return image
+
+
+def _use_gpu():
+    """
+    Checks once whether cupy is installed and can see a GPU, and remembers the answer
+    :return: true if the zooms should run on the GPU
+    """
+    global _gpu_available
+    if _gpu_available is None:
+        try:
+            _gpu_available = cp is not None and cp.cuda.runtime.getDeviceCount() > 0
+        except Exception:
+            _gpu_available = False
+    return _gpu_available
+
 
-            # Get the intercept and slope
-            intercept = slices[slice_number].RescaleIntercept
-            slope = slices[slice_number].RescaleSlope
+def _zoom(image, factor, order=3):
+    """
+    Zooms the image with spline interpolation, on the GPU when cupy is installed and can see a device
+    :param image: NumPy array to zoom
+    :param factor: zoom factor along each axis
+    :param order: spline order
+    :return: zoomed NumPy array
+    """
+    if _use_gpu():
+        return cp.asnumpy(_zoom_gpu(cp.asarray(image), factor, order=order, mode='nearest'))
 
-            # Change the slope
-            image[slice_number] = slope * image[slice_number].astype(np.float64)
-            image[slice_number] = image[slice_number].astype(np.int16)
+    return scipy.ndimage.zoom(image, factor, order=order, mode='nearest')
 
-            # Add the intercept
-            image[slice_number] += np.int16(intercept)
 
-    return np.array(image, dtype=np.int16)
+def _nn_zoom_binary(image, factor):
+    """
+    Zooms a binary image with nearest neighbor, which is just picking out the right indices. Uses the same grid as
+    scipy's zoom (corners line up) so the mask stays registered with the resampled scans.
+    :param image: NumPy array to zoom
+    :param factor: zoom factor along each axis
+    :return: zoomed NumPy array
+    """
+    out_shape = [int(round(s * f)) for s, f in zip(image.shape, factor)]
+    indices = [np.minimum(np.rint(np.arange(o) * (s - 1) / max(o - 1, 1)).astype(np.intp), s - 1)
+               for o, s in zip(out_shape, image.shape)]
+    return image[np.ix_(*indices)]
 
 
 def resample(image, scan, new_spacing=[1, 1, 1]):
@@ -114,7 +193,7 @@ def resample(image, scan, new_spacing=[1, 1, 1]):
     new_spacing = spacing / real_resize_factor
 
     # Actually use interpolation to create new image (fuck it takes long)
-    image = scipy.ndimage.interpolation.zoom(image, real_resize_factor, mode='nearest')
+    image = _zoom(image, real_resize_factor)
 
     return image, new_spacing
 
@@ -144,8 +223,8 @@ def resample_mask(image, new_spacing=[1, 1, 1]):
     # New spacing
     new_spacing = spacing / real_resize_factor
 
-    # Actually use interpolation to create new image (it takes long)
-    image = scipy.ndimage.interpolation.zoom(image, real_resize_factor, mode='nearest')
+    # The mask is binary so nearest neighbor is all it needs, no interpolation
+    image = _nn_zoom_binary(image, real_resize_factor)
 
     return image, new_spacing
 
@@ -183,21 +262,27 @@ def resample_mask_call(image, new_spacing=[1, 1, 1]):
 def largest_label_volume(im, bg=-1):
     """
     Finds the largest volume in a scan of the same value
-    :param im: 3D NumPy array representing image
+    :param im: 3D NumPy array of integer labels
     :param bg: int that will be ignored as background
     :return: largest volume label
     """
+    if im.dtype.kind not in 'biu':
+        raise ValueError('largest_label_volume needs an integer label image, got %s' % im.dtype)
+
+    # Shift everything up so negative labels (and a negative bg) fit into bincount
+    flat = im.ravel().astype(np.intp, copy=False)
+    offset = -min(int(flat.min()) if flat.size else 0, bg, 0)
 
-    # Finds the unique labels and the amount of times they pop up
-    vals, counts = np.unique(im, return_counts=True)
+    # Counts how many times each label pops up, a single pass instead of sorting like np.unique
+    counts = np.bincount(flat + offset if offset else flat)
 
     # Gets rid of background counts
-    counts = counts[vals != bg]
-    vals = vals[vals != bg]
+    if 0 <= bg + offset < len(counts):
+        counts[bg + offset] = 0
 
     # If there is a large volume, return it, otherwise it's all background
-    if len(counts) > 0:
-        return vals[np.argmax(counts)]
+    if counts.any():
+        return np.argmax(counts) - offset
     else:
         return None
 
@@ -273,9 +358,10 @@ def normalize(image, min_bound=-1000.0, max_bound=400.0):
     :param max_bound: maximum value
     :return: normalized image
     """
-    image = (image - min_bound) / (max_bound - min_bound)
-    image[image > 1] = 1.
-    image[image < 0] = 0.
+    # Only the subtraction makes a new array, everything after works in place
+    image = image - min_bound
+    image *= 1. / (max_bound - min_bound)
+    np.clip(image, 0., 1., out=image)
     return image
 
 
@@ -341,44 +427,60 @@ def load_image(path):
     return ct_resampled_image, pet_resampled_image, tumor_resampled_mask1
 
 
-def process_data(parent_directory, save_directory):
+def process_patient(parent_directory, save_directory, patient):
+    """
+    This loads a single patient folder and saves its CT, PET, and tumor mask as numpy arrays
+    :param parent_directory: folder with all the patient folders
+    :param save_directory: folder to save the processed patient in
+    :param patient: name of the patient folder
+    :return: none
+    """
+    print('Patient: ', patient)
+
+    # Start timer
+    start_time = time.time()
+
+    try:
+        # Load the image of the given patient
+        ct, pet, mask = load_image(parent_directory + "/" + patient)
+    except Exception:
+        traceback.print_exc()
+        print('Error loading patient ', patient, '...')
+        return
+
+    # Create a directory if it doesn't exist
+    if not os.path.exists(save_directory + '/' + patient):
+        os.makedirs(save_directory + '/' + patient)
+
+    # Save as numpy arrays, the mask is binary so it doesn't need more than a bool
+    np.save(save_directory + '/' + patient + "/PET", pet.astype(np.int16, copy=False))
+    np.save(save_directory + '/' + patient + "/CT", ct.astype(np.int16, copy=False))
+    np.save(save_directory + '/' + patient + "/mask", mask.astype(bool))
+
+    # Print time
+    print("--- Patient %s data loaded in %s seconds ---" % (patient, time.time() - start_time))
+
+
+def process_data(parent_directory, save_directory, max_workers=2):
     """
     This takes a parent directory and processes all the patients, as folders, within it
     :param parent_directory:
+    :param save_directory: folder to save the processed patients in
+    :param max_workers: how many patients to process at once. Each one needs up to ~10 GB of memory (and shares the
+                        GPU when cupy is used), so only raise this if there is room for it
     :return: none
     """
     # Start timer
     start_time = time.time()
 
     # Get the list of folders in patients
-    patients = sorted(os.listdir(parent_directory))
-
-    # Loop through every patient
-    for i in range(2, len(patients), 3):
-        patient = patients[i]
-        print('Patient: ', patient)
+    patients = sorted(os.listdir(parent_directory))[2::3]
 
-        # Start timer
-        start_time1 = time.time()
-
-        try:
-            # Load the image of the given patient
-            ct, pet, mask = load_image(parent_directory + "/" + patient)
-        except:
-            print('Error loading patient...')
-            continue
-
-        # Create a directory if it doesn't exist
-        if not os.path.exists(save_directory + '/' + patient):
-            os.makedirs(save_directory + '/' + patient)
-
-        # Save as numpy arrays
-        np.save(save_directory + '/' + patient + "/PET", pet)
-        np.save(save_directory + '/' + patient + "/CT", ct)
-        np.save(save_directory + '/' + patient + "/mask", mask)
-
-        # Print time
-        print("--- Patient data loaded in %s seconds ---" % (time.time() - start_time1))
+    # Process a few patients at once so one can compute while another is waiting on the disk
+    # Spawn instead of fork, CUDA can't be used in a child forked from a process that already started it
+    with ProcessPoolExecutor(max_workers=max(min(max_workers, len(patients)), 1),
+                             mp_context=multiprocessing.get_context('spawn')) as executor:
+        list(executor.map(process_patient, repeat(parent_directory), repeat(save_directory), patients))
 
     # Print time
     print("--- Total time elapsed: %s seconds ---" % (time.time() - start_time))